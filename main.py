@@ -1,5 +1,8 @@
 import asyncio
+import json
+import os
 import re
+from pathlib import Path
 
 from astrbot.api import logger
 from astrbot.api.event import filter
@@ -9,16 +12,40 @@ from astrbot.core.platform.sources.aiocqhttp.aiocqhttp_message_event import (
     AiocqhttpMessageEvent,
 )
 
+try:
+    from astrbot.api.star import StarTools
+except ImportError:  # 旧版 AstrBot 没有 StarTools
+    StarTools = None
+
+_GID_RE = re.compile(r"\d{6,10}")
+
 
 class MonitorPlugin(Star):
     def __init__(self, context: Context):
         super().__init__(context)
+        if StarTools is not None:
+            data_dir = StarTools.get_data_dir("astrbot_plugin_monitor")
+        else:
+            data_dir = Path("data/plugin_data/astrbot_plugin_monitor")
+            data_dir.mkdir(parents=True, exist_ok=True)
+        self.data_file = data_dir / "monitor_map.json"
         # 监听群 -> 被监听群
-        self.monitor_map: dict[int, int] = {}
+        self.monitor_map: dict[int, int] = self._load_monitor_map()
+        # 被监听群 -> 监听群集合
+        self.reverse_map: dict[int, set[int]] = {}
+        for from_gid, target_gid in self.monitor_map.items():
+            self.reverse_map.setdefault(target_gid, set()).add(from_gid)
+        self._save_task: asyncio.Task | None = None
+        # 限制同时进行的转发请求数
+        self._send_sem = asyncio.Semaphore(16)
 
     # ---------- 工具函数 ----------
     def extract_group_ids(self, text: str) -> list[int]:
-        return [int(gid) for gid in re.findall(r"\d{6,10}", text)]
+        return [int(gid) for gid in _GID_RE.findall(text)]
+
+    def _current_gid(self, event: AiocqhttpMessageEvent) -> int:
+        """当前群号，私聊时为 0"""
+        return int(event.get_group_id() or 0)
 
     def get_group_ids(self, event: AiocqhttpMessageEvent) -> list[int]:
         reply_seg = next(
@@ -27,24 +54,73 @@ class MonitorPlugin(Star):
         ref_text = reply_seg.message_str if reply_seg else ""
         return self.extract_group_ids(ref_text or event.message_str)
 
-    async def build_forward_nodes(
-        self, messages: list[dict], user_id: int | None = None
-    ):
-        """构建转发节点 - 保持原始逻辑"""
+    def _load_monitor_map(self) -> dict[int, int]:
+        """从磁盘加载监听关系"""
+        if not self.data_file.exists():
+            return {}
+        try:
+            data = json.loads(self.data_file.read_text(encoding="utf-8"))
+            return {int(k): int(v) for k, v in data.items()}
+        except Exception as e:
+            logger.error(f"加载监听关系失败: {e}")
+            return {}
+
+    def _save_monitor_map(self):
+        """将监听关系写入磁盘"""
+        tmp_file = self.data_file.with_name(self.data_file.name + ".tmp")
+        try:
+            tmp_file.write_text(
+                json.dumps({str(k): v for k, v in self.monitor_map.items()}),
+                encoding="utf-8",
+            )
+            os.replace(tmp_file, self.data_file)
+        except Exception as e:
+            logger.error(f"保存监听关系失败: {e}")
+
+    def _schedule_save(self, delay: float = 2.0):
+        """合并短时间内的多次修改，只写一次盘"""
+        if self._save_task and not self._save_task.done():
+            return
+
+        async def delayed_save():
+            await asyncio.sleep(delay)
+            self._save_monitor_map()
+
+        self._save_task = asyncio.create_task(delayed_save())
+
+    def _remove_listener(self, target_gid: int, from_gid: int):
+        """从反向索引中移除监听关系"""
+        listeners = self.reverse_map.get(target_gid)
+        if listeners is None:
+            return
+        listeners.discard(from_gid)
+        if not listeners:
+            del self.reverse_map[target_gid]
+
+    def build_forward_nodes(self, messages: list[dict]):
+        """构建转发节点，跳过缺少发送者、内容或 user_id 的消息"""
         nodes = []
+        append = nodes.append
+        skipped = 0
         for msg in messages:
-            if user_id and msg["sender"]["user_id"] != user_id:
+            sender = msg.get("sender")
+            content = msg.get("message")
+            uid = sender.get("user_id") if sender else None
+            if uid is None or content is None:
+                skipped += 1
                 continue
-            nodes.append(
+            append(
                 {
                     "type": "node",
                     "data": {
-                        "name": msg["sender"]["nickname"],
-                        "uin": msg["sender"]["user_id"],
-                        "content": msg["message"],
+                        "name": sender.get("nickname", ""),
+                        "uin": uid,
+                        "content": content,
                     },
                 }
             )
+        if skipped:
+            logger.warning(f"有 {skipped} 条消息格式异常，已跳过")
         return nodes
 
     @filter.permission_type(filter.PermissionType.ADMIN)
@@ -58,33 +134,42 @@ class MonitorPlugin(Star):
         """抽查 [群号] [数量]"""
         args = event.message_str.split()
         count = next(
-            (int(arg) for arg in args if arg.isdigit() and int(arg) < 1000), 20
+            (n for arg in args if arg.isdigit() and (n := int(arg)) < 1000), 20
         )
 
         group_ids = [group_id] if group_id else self.get_group_ids(event)
         if not group_ids:
             yield event.plain_result("未指定要抽查的群号")
             return
-        target_group = int(event.get_group_id())
+        target_group = self._current_gid(event)
         target_user = int(event.get_sender_id())
+        sem = asyncio.Semaphore(8)
+
         async def check_single(gid: int):
-            try:
-                result = await event.bot.get_group_msg_history(
-                    group_id=gid, count=count
-                )
-                nodes = await self.build_forward_nodes(result["messages"], user_id)
-                if not nodes:
-                    return
-                if target_group:
-                    await event.bot.send_group_forward_msg(
-                        group_id=target_group, messages=nodes
-                    )
-                else:
-                    await event.bot.send_private_forward_msg(
-                        user_id=target_user, messages=nodes
+            async with sem:
+                try:
+                    result = await event.bot.get_group_msg_history(
+                        group_id=gid, count=count
                     )
-            except Exception as e:
-                logger.error(f"抽查群({gid})失败: {e}")
+                    messages = result.get("messages", [])
+                    if user_id:
+                        messages = [
+                            m for m in messages
+                            if (m.get("sender") or {}).get("user_id") == user_id
+                        ]
+                    nodes = self.build_forward_nodes(messages)
+                    if not nodes:
+                        return
+                    if target_group:
+                        await event.bot.send_group_forward_msg(
+                            group_id=target_group, messages=nodes
+                        )
+                    else:
+                        await event.bot.send_private_forward_msg(
+                            user_id=target_user, messages=nodes
+                        )
+                except Exception as e:
+                    logger.error(f"抽查群({gid})失败: {e}")
 
         await asyncio.gather(*(check_single(gid) for gid in group_ids))
         event.stop_event()
@@ -113,33 +198,42 @@ class MonitorPlugin(Star):
     @filter.command("监听")
     async def monitor(self, event: AiocqhttpMessageEvent, group_id: int | None = None):
         """监听 [群号]"""
-        from_gid = int(event.get_group_id())
+        from_gid = self._current_gid(event)
         if not from_gid:
             yield event.plain_result("只能在群聊中使用监听命令")
             return
 
         group_ids = self.get_group_ids(event) if not group_id else [group_id]
+        if not group_ids:
+            yield event.plain_result("未指定要监听的群号")
+            return
         target_gid = group_ids[0]
         # 覆盖监听目标
         old_target = self.monitor_map.get(from_gid)
-        self.monitor_map[from_gid] = target_gid
-
         if old_target == target_gid:
             yield event.plain_result(f"你已经在监听群 {target_gid}")
-        else:
-            yield event.plain_result(f"开始监听群 {target_gid}")
+            return
+
+        self.monitor_map[from_gid] = target_gid
+        if old_target is not None:
+            self._remove_listener(old_target, from_gid)
+        self.reverse_map.setdefault(target_gid, set()).add(from_gid)
+        self._schedule_save()
+        yield event.plain_result(f"开始监听群 {target_gid}")
 
     @filter.command("取消监听")
     async def unmonitor(
         self, event: AiocqhttpMessageEvent
     ):
         """取消监听"""
-        from_gid = int(event.get_group_id())
+        from_gid = self._current_gid(event)
         if not from_gid:
             yield event.plain_result("只能在群聊中使用取消监听命令")
             return
         if from_gid in self.monitor_map:
             target_gid = self.monitor_map.pop(from_gid)
+            self._remove_listener(target_gid, from_gid)
+            self._schedule_save()
             yield event.plain_result(f"已取消监听群聊: {target_gid}")
         else:
             yield event.plain_result("你当前没有监听任何群")
@@ -147,37 +241,49 @@ class MonitorPlugin(Star):
     @filter.event_message_type(filter.EventMessageType.ALL)
     async def on_message(self, event: AiocqhttpMessageEvent):
         """实时转发被监听群的消息（支持图片）"""
-        if not event.message_str or any(isinstance(seg, Reply) for seg in event.get_messages()):
+        if not self.monitor_map:
             return
         group_id = event.get_group_id()
         if not group_id:
             return
-        # 找出所有监听 source_gid 的监听者群
-        listeners = [
-            from_gid
-            for from_gid, target_gid in self.monitor_map.items()
-            if target_gid == int(group_id)
-        ]
+        # 找出所有监听该群的监听者群
+        listeners = self.reverse_map.get(int(group_id))
         if not listeners:
             return
-        
+        if not event.message_str:
+            return
+        messages = event.get_messages()
+        if any(isinstance(seg, Reply) for seg in messages):
+            return
+
         sender_name = event.get_sender_name()
-        forward_msg = f"[来自群{group_id}的{sender_name}]\n{event.message_str}"
-        
+        parts = [f"[来自群{group_id}的{sender_name}]", event.message_str]
+
         # ✅ 关键改动：从消息链中提取图片
-        messages = event.get_messages()
         for seg in messages:
             # 检查是否是 Image 对象
             if isinstance(seg, Image):
                 # Image 对象有 url 属性
                 if hasattr(seg, 'url') and seg.url:
                     # 追加图片 CQ 码
-                    forward_msg += f"\n[CQ:image,file={seg.url}]"
+                    parts.append(f"[CQ:image,file={seg.url}]")
+        forward_msg = "\n".join(parts)
 
-        for from_gid in listeners:
+        async def send_single(from_gid: int):
             try:
-                await event.bot.send_group_msg(group_id=from_gid, message=forward_msg)
+                async with self._send_sem:
+                    await event.bot.send_group_msg(
+                        group_id=from_gid, message=forward_msg
+                    )
             except Exception as e:
                 logger.warning(f"转发到群 {from_gid} 失败: {e}")
 
+        await asyncio.gather(*(send_single(gid) for gid in listeners))
+
         event.stop_event()
+
+    async def terminate(self):
+        """插件卸载时立即保存未落盘的监听关系"""
+        if self._save_task and not self._save_task.done():
+            self._save_task.cancel()
+            self._save_monitor_map()